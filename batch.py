@@ -0,0 +1,192 @@
+"""Generate timetable archives for many routes of a feed in one run.
+
+    python batch.py feed.zip template.docx --routes all --output-dir out
+    python batch.py feed.zip template.docx --week 2024-09-02 --routes 12 14 --combine 12=N:N12,S:S12
+
+The feed and its service calendar are loaded once and shared by every route;
+each route is written to <output-dir>/<route_id>.zip. A manifest of stop
+fingerprints is kept next to each archive, so a later run only re-renders
+the stops whose timetable, context or template changed (--full renders all).
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+from feed_cache import FeedCache
+from lean_feed import read_lean_feed
+from service_calendar import ServiceCalendar
+from pipeline import get_first_and_subsequent_weeks, get_week_dates, build_route_timetable
+from manifest import DocumentManifest, publish_file
+from profiling import RunProfile, profile_stage
+from documents import generate_word_documents, create_document_executor, read_template_bytes, sanitize_filename, DocumentArchive, DEFAULT_WORKERS
+
+
+class ConsoleStatus:
+    # Stand-in for st.status: progress labels overwrite one line when attached to a terminal
+    def __init__(self, prefix, stream=sys.stderr):
+        self.prefix = prefix
+        self.stream = stream
+
+    def update(self, label=None, state=None, **kwargs):
+        tty = self.stream.isatty()
+        if label is None or (state == 'running' and not tty):
+            return
+        if tty:
+            self.stream.write(f"\r\x1b[K{self.prefix}{label}" + ('' if state == 'running' else '\n'))
+        else:
+            self.stream.write(f"{self.prefix}{label}\n")
+        self.stream.flush()
+
+
+def parse_combine(specs):
+    """Parse ``MAIN=ALIAS:ROUTE[,ALIAS:ROUTE...]`` specs into {main: [(alias, route_id)]}."""
+    combined = {}
+    for spec in specs:
+        main, sep, additional = spec.partition('=')
+        if not sep or not main or not additional:
+            raise ValueError(f"Invalid combine spec {spec!r}, expected MAIN=ALIAS:ROUTE[,ALIAS:ROUTE...]")
+        for item in additional.split(','):
+            alias, sep, route_id = item.rpartition(':')
+            if not sep or not route_id:
+                raise ValueError(f"Invalid combined route {item!r} in {spec!r}, expected ALIAS:ROUTE")
+            combined.setdefault(main, []).append((alias, route_id))
+    return combined
+
+
+def parse_week(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date {value!r}, expected YYYY-MM-DD")
+
+
+def load_feed(path, use_cache=True):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if use_cache:
+        return FeedCache().load(data, lean=True)
+    return read_lean_feed(data)
+
+
+def generate_routes(feed, service_calendar, route_ids, week_dates, template_bytes, output_dir, combine=None, workers=None, incremental=True, profile_options=None, stream=sys.stderr):
+    """Write one archive per route, returning {route_id: (archive path, changes, profile)}.
+
+    changes lists the stop ids that are new, changed, unchanged or removed
+    since the archive's previous manifest. profile is the route's RunProfile,
+    built from profile_options, or None without them. Routes without service
+    during week_dates map to None and get no archive.
+    """
+    combine = combine or {}
+    os.makedirs(output_dir, exist_ok=True)
+    archives = {}
+    # One worker pool serves every route, so workers start and import their libraries once
+    workers = workers or DEFAULT_WORKERS
+    executor = create_document_executor(workers) if workers > 1 else None
+    try:
+        for route_id in route_ids:
+            prefix = f"[{route_id}] "
+            profile = RunProfile(**profile_options) if profile_options is not None else None
+            route_timetable = build_route_timetable(feed, service_calendar, route_id, week_dates, combine.get(route_id, ()), profile=profile)
+            if route_timetable is None:
+                stream.write(f"{prefix}No data available for the selected route and date.\n")
+                archives[route_id] = None
+                continue
+
+            timetable, pattern_dates, headsign_index_dict = route_timetable
+            archive_path = os.path.join(output_dir, sanitize_filename(f"{route_id}.zip"))
+            previous = DocumentManifest.load(archive_path)
+            manifest = DocumentManifest()
+            archive = DocumentArchive()
+            stats = {}
+            try:
+                generate_word_documents(timetable, pattern_dates, route_id, feed, headsign_index_dict, ConsoleStatus(prefix, stream), template_bytes,
+                                        workers=workers, archive=archive, previous=previous if incremental else None, manifest=manifest, stats=stats, profile=profile, executor=executor)
+            finally:
+                previous.close()
+
+            with profile_stage(profile, 'write_archive'):
+                fd, tmp_path = tempfile.mkstemp(prefix='.archive.', dir=output_dir)
+                with archive.close() as archive_file, os.fdopen(fd, 'wb') as out:
+                    shutil.copyfileobj(archive_file, out)
+                publish_file(tmp_path, archive_path)
+                manifest.save(archive_path)
+
+            changes = manifest.changes(previous)
+            stream.write(prefix + ', '.join(f"{len(stop_ids)} {kind}" for kind, stop_ids in changes.items()) + ' stops; '
+                         f"table fragments: {stats['fragment_hits']} reused, {stats['fragment_misses']} built\n")
+            for kind in ('changed', 'removed'):
+                if changes[kind]:
+                    stream.write(f"{prefix}{kind}: {' '.join(map(str, changes[kind]))}\n")
+            archives[route_id] = (archive_path, changes, profile)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return archives
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Word timetables for routes of a GTFS feed.")
+    parser.add_argument('feed', help="GTFS zip file")
+    parser.add_argument('template', help="Word template (.docx)")
+    parser.add_argument('--week', type=parse_week, help="Monday of the week to generate (YYYY-MM-DD), defaults to the first valid Monday")
+    parser.add_argument('--routes', nargs='+', default=['all'], help="route_ids to generate, or 'all' (default)")
+    parser.add_argument('--combine', action='append', default=[], metavar='MAIN=ALIAS:ROUTE[,...]',
+                        help="combine other lines into MAIN's timetables, their headsigns prefixed with ALIAS; repeatable")
+    parser.add_argument('--output-dir', default='timetables', help="directory for the per-route archives (default: timetables)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f"parallel document workers (default: {DEFAULT_WORKERS})")
+    parser.add_argument('--full', action='store_true', help="re-render every stop, ignoring the manifests of previous runs")
+    parser.add_argument('--profile-report', metavar='PATH', help="write per-stage timings, memory and per-stop render times as JSON")
+    parser.add_argument('--trace-memory', action='store_true', help="with --profile-report, also record each stage's tracemalloc peak (slower)")
+    parser.add_argument('--profile-slowest-stop', action='store_true', help="with --profile-report, include a cProfile of each route's slowest stop")
+    parser.add_argument('--no-cache', action='store_true', help="parse the feed directly instead of going through the feed cache")
+    args = parser.parse_args(argv)
+
+    try:
+        combine = parse_combine(args.combine)
+    except ValueError as e:
+        parser.error(str(e))
+
+    profile_options = None
+    setup_profile = None
+    if args.profile_report:
+        profile_options = {'trace_memory': args.trace_memory, 'profile_slowest_stop': args.profile_slowest_stop}
+        setup_profile = RunProfile(**profile_options)
+
+    with profile_stage(setup_profile, 'load_feed') as stage:
+        feed = load_feed(args.feed, use_cache=not args.no_cache)
+        stage['rows'] = len(feed.stop_times)
+    with profile_stage(setup_profile, 'service_calendar', rows=len(feed.trips)):
+        service_calendar = ServiceCalendar(feed)
+    valid_mondays = get_first_and_subsequent_weeks(service_calendar)
+    if not valid_mondays:
+        parser.error("No valid Mondays found within the feed's date range.")
+    monday = args.week or valid_mondays[0]
+    if monday not in valid_mondays:
+        parser.error(f"{monday} is not a valid Monday of the feed, choose from {valid_mondays[0]} to {valid_mondays[-1]}")
+
+    known_routes = feed.routes['route_id'].drop_duplicates().tolist()
+    route_ids = known_routes if args.routes == ['all'] else args.routes
+    unknown = [route_id for route_id in route_ids + [r for routes in combine.values() for _, r in routes] + list(combine) if route_id not in known_routes]
+    if unknown:
+        parser.error(f"Unknown route_id(s): {', '.join(sorted(set(unknown)))}")
+
+    archives = generate_routes(feed, service_calendar, route_ids, get_week_dates(monday), read_template_bytes(args.template),
+                               args.output_dir, combine=combine, workers=args.workers, incremental=not args.full,
+                               profile_options=profile_options)
+    written = [result for result in archives.values() if result]
+    if args.profile_report:
+        report = {
+            'setup': setup_profile.to_dict()['stages'],
+            'routes': {route_id: result[2].to_dict() for route_id, result in archives.items() if result},
+        }
+        with open(args.profile_report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1, ensure_ascii=False)
+    print(f"Wrote {len(written)} of {len(route_ids)} route archives to {args.output_dir}")
+    return 0 if written else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
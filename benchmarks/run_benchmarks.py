@@ -0,0 +1,216 @@
+"""Time and measure memory of each pipeline stage on a synthetic feed.
+
+    python benchmarks/run_benchmarks.py --routes 40 --stops 30 --trips 120 --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+
+Each stage is timed `repeat` times, then run once more under tracemalloc for
+its peak allocation on the Python heap. tracemalloc does not see Arrow
+buffers, which hold the feed's strings, so on Linux each stage runs once
+more for its peak RSS growth, after memory freed by the earlier runs has
+been handed back to the OS (worker processes it starts are not counted).
+Stages take their inputs from the previous stages, which
+are computed outside the measurement. Every run starts from cold caches:
+load_feed_cold parses into an empty feed cache and document rendering gets a
+fresh fragment cache, while load_feed_warm reads back an already cached feed.
+Results are written as JSON and can be compared with an earlier run's file.
+"""
+import argparse
+import ctypes
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import pyarrow as pa
+from synthetic_gtfs import generate_feed, generate_template, add_feed_arguments, feed_parameters
+from lean_feed import read_lean_feed
+from feed_cache import FeedCache
+from service_calendar import ServiceCalendar
+from pipeline import TIMETABLE_COLUMNS, FINISH, get_first_and_subsequent_weeks, get_week_dates, get_route_timetable, classify_stops, index_headsigns
+from utils import group_all_dates_by_timetables, organize_times_by_hour
+from profiling import current_rss, peak_rss
+from documents import HEADSIGN_COLORS, FragmentCache, create_styled_table, generate_word_documents, create_zip_file
+
+
+class NullStatus:
+    def update(self, **kwargs):
+        pass
+
+
+def release_free_memory():
+    # Otherwise a run reuses what earlier runs freed and its growth is hidden
+    gc.collect()
+    pa.default_memory_pool().release_unused()
+    malloc_trim = getattr(ctypes.CDLL(None), 'malloc_trim', None)  # glibc only
+    if malloc_trim is not None:
+        malloc_trim(0)
+
+
+def peak_rss_growth(fn):
+    # Linux lets a process reset its own RSS high-water mark
+    release_free_memory()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    start = current_rss()
+    fn()
+    return peak_rss('self') - start
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {
+        'runs': repeat,
+        'seconds_min': min(timings),
+        'seconds_median': statistics.median(timings),
+        'python_heap_peak_bytes': peak,
+        'rss_peak_growth_bytes': peak_rss_growth(fn),
+    }
+
+
+def run_benchmarks(feed_path, template_path, cache_dir, repeat=3, workers=1, route_id=None, week=0, report=print):
+    stages = {}
+    counts = {}
+
+    def stage(name, fn):
+        result, stages[name] = measure(fn, repeat)
+        rss = stages[name]['rss_peak_growth_bytes']
+        report(f"{name:<30} {stages[name]['seconds_median'] * 1000:10.1f} ms {stages[name]['python_heap_peak_bytes'] / 1024 ** 2:10.1f} MiB "
+               + (f"{rss / 1024 ** 2:10.1f} MiB" if rss is not None else f"{'n/a':>14}"))
+        return result
+
+    report(f"{'stage':<30} {'median':>13} {'Python heap':>14} {'RSS growth':>14}")
+
+    with open(feed_path, 'rb') as f:
+        data = f.read()
+    with open(template_path, 'rb') as f:
+        template_bytes = f.read()
+
+    stage('read_lean_feed', lambda: read_lean_feed(data))
+    # The app's path: a new cache directory per cold run, then one shared warm cache
+    os.makedirs(cache_dir, exist_ok=True)
+    stage('load_feed_cold', lambda: FeedCache(tempfile.mkdtemp(dir=cache_dir)).load(data, lean=True))
+    feed_cache = FeedCache(os.path.join(cache_dir, 'warm'))
+    feed_cache.load(data, lean=True)
+    feed = stage('load_feed_warm', lambda: feed_cache.load(data, lean=True))
+    counts['stop_times'] = len(feed.stop_times)
+    counts['trips'] = len(feed.trips)
+
+    def load_calendar():
+        service_calendar = ServiceCalendar(feed)
+        return service_calendar, get_first_and_subsequent_weeks(service_calendar)
+
+    service_calendar, valid_mondays = stage('get_first_and_subsequent_weeks', load_calendar)
+    week_dates = get_week_dates(valid_mondays[week])
+    pattern_dates = service_calendar.group_dates(week_dates)
+    route_id = route_id or feed.routes['route_id'].iloc[0]
+
+    timetable = stage('get_route_timetable', lambda: get_route_timetable(feed, service_calendar, route_id, week_dates, TIMETABLE_COLUMNS))
+    counts['timetable_rows'] = len(timetable)
+
+    timetable = stage('classify_stops', lambda: classify_stops(timetable.copy()))
+    timetable = timetable[timetable['stop_type'] != FINISH].reset_index(drop=True)
+
+    headsign_index_dict = stage('index_headsigns', lambda: index_headsigns(timetable, pattern_dates))
+
+    grouped = stage('group_dates_by_timetables', lambda: group_all_dates_by_timetables(timetable, pattern_dates))
+    group_timetables = [group_timetable for timetables in grouped.values() for _, group_timetable in timetables.values()]
+    counts['stops'] = len(grouped)
+    counts['timetable_groups'] = len(group_timetables)
+
+    grids = stage('organize_times_by_hour', lambda: [
+        organize_times_by_hour(group_timetable['arrival_seconds'], group_timetable['headsign_index']) for group_timetable in group_timetables
+    ])
+
+    stage('create_styled_table', lambda: [create_styled_table(grid, HEADSIGN_COLORS, headsign_grid) for grid, headsign_grid in grids])
+
+    doc_files = stage('generate_word_documents', lambda: [
+        (name, buffer.getvalue()) for name, buffer in
+        generate_word_documents(timetable, pattern_dates, route_id, feed, headsign_index_dict, NullStatus(), template_bytes, workers=workers,
+                                fragment_cache=FragmentCache())
+    ])
+    counts['documents'] = len(doc_files)
+
+    stage('create_zip_file', lambda: create_zip_file([(name, io.BytesIO(doc)) for name, doc in doc_files]).close())
+
+    return {'route_id': route_id, 'week': week_dates[0], 'counts': counts, 'stages': stages}
+
+
+def compare(results, previous, report=print):
+    report(f"{'stage':<28} {'previous':>12} {'current':>12} {'ratio':>8}")
+    for name, current in results['stages'].items():
+        before = previous['stages'].get(name)
+        if before is None:
+            continue
+        ratio = current['seconds_median'] / before['seconds_median'] if before['seconds_median'] else float('nan')
+        report(f"{name:<28} {before['seconds_median'] * 1000:10.1f}ms {current['seconds_median'] * 1000:10.1f}ms {ratio:8.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the timetable pipeline stage by stage.")
+    add_feed_arguments(parser)
+    parser.add_argument('--feed', help="benchmark this GTFS zip instead of generating one")
+    parser.add_argument('--template', help="Word template to render (default: a generated one)")
+    parser.add_argument('--route', help="route_id to benchmark (default: the first route)")
+    parser.add_argument('--week', type=int, default=0, help="index of the valid Monday to use (default: 0)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage (default: 3)")
+    parser.add_argument('--workers', type=int, default=1, help="document workers for generate_word_documents (default: 1)")
+    parser.add_argument('--output', help="write the results as JSON to this path")
+    parser.add_argument('--compare', metavar='RESULTS', help="compare against an earlier JSON results file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feed_path = args.feed
+        if feed_path is None:
+            feed_path = os.path.join(tmp_dir, 'feed.zip')
+            generate_feed(feed_path, **feed_parameters(args))
+        template_path = args.template
+        if template_path is None:
+            template_path = os.path.join(tmp_dir, 'template.docx')
+            generate_template(template_path)
+
+        results = run_benchmarks(feed_path, template_path, os.path.join(tmp_dir, 'feed_cache'), repeat=args.repeat, workers=args.workers, route_id=args.route, week=args.week)
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'feed': args.feed or feed_parameters(args),
+        'repeat': args.repeat,
+        'workers': args.workers,
+        **results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Synthetic GTFS feeds and Word templates for the benchmarks.
+
+    python benchmarks/synthetic_gtfs.py feed.zip --routes 40 --stops 30 --trips 120
+
+Every route runs both ways along its own line of stops; every fifth stop is
+a hub shared by all routes. Each route has `headsigns` destinations per
+direction, the shorter ones ending part way along the line. Trips are spread
+over `patterns` services with different weekday sets, plus a few
+calendar_dates exceptions, so a week holds several distinct timetables.
+"""
+import argparse
+import csv
+import io
+import random
+import zipfile
+from docx import Document
+
+WEEKDAY_SETS = [
+    (1, 1, 1, 1, 1, 0, 0),
+    (0, 0, 0, 0, 0, 1, 0),
+    (0, 0, 0, 0, 0, 0, 1),
+    (1, 1, 1, 1, 0, 0, 0),
+    (0, 0, 0, 0, 1, 0, 0),
+    (0, 0, 1, 0, 0, 0, 0),
+    (0, 0, 0, 0, 0, 1, 1),
+]
+
+
+def _table(z, name, header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    z.writestr(name, buffer.getvalue())
+
+
+def generate_feed(path, routes=10, stops=20, trips=60, patterns=4, headsigns=2, start_date='20240101', end_date='20240630', seed=1):
+    """Write a GTFS zip to path (a filename or binary file object).
+
+    trips is the number of weekday departures per route and direction; the
+    other patterns run a third as many.
+    """
+    rng = random.Random(seed)
+    patterns = max(1, min(patterns, len(WEEKDAY_SETS)))
+    service_ids = [f'P{p}' for p in range(patterns)]
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        _table(z, 'agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+               [['A', 'Synthetic', 'http://example.com', 'Europe/Paris']])
+        _table(z, 'routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color', 'route_text_color'],
+               [[f'R{r}', 'A', f'{r}', f'Line {r}', 3, f'{rng.randrange(0x1000000):06X}', 'FFFFFF'] for r in range(routes)])
+
+        hubs = [s for s in range(stops) if s % 5 == 4]
+        stop_rows = [[f'S{r}_{s}', f'Stop {r} {s}', 48 + s * 0.01, 2 + r * 0.01] for r in range(routes) for s in range(stops) if s not in hubs]
+        stop_rows += [[f'H{s}', f'Hub {s}', 48 + s * 0.01, 2] for s in hubs]
+        _table(z, 'stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'], stop_rows)
+
+        _table(z, 'calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+               [[service_id, *WEEKDAY_SETS[p], start_date, end_date] for p, service_id in enumerate(service_ids)])
+        exceptions = [[service_ids[0], start_date[:6] + '15', 2]]
+        if patterns > 2:
+            exceptions.append([service_ids[2], start_date[:6] + '15', 1])
+        _table(z, 'calendar_dates.txt', ['service_id', 'date', 'exception_type'], exceptions)
+
+        trip_rows = []
+        with z.open('stop_times.txt', 'w') as f:
+            stop_times = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            writer = csv.writer(stop_times)
+            writer.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+            for r in range(routes):
+                for p, service_id in enumerate(service_ids):
+                    departures = trips if p == 0 else max(trips // 3, 1)
+                    for t in range(departures):
+                        for direction in (0, 1):
+                            trip_id = f'T{r}_{service_id}_{t}_{direction}'
+                            # The main destination runs the whole line, the others stop short
+                            branch = t % headsigns
+                            length = stops - branch * stops // (headsigns + 1)
+                            sequence = list(range(stops))[::-1 if direction else 1][:length]
+                            headsign = f'Stop {r} {sequence[-1]}' if sequence[-1] not in hubs else f'Hub {sequence[-1]}'
+                            trip_rows.append([f'R{r}', service_id, trip_id, headsign, direction])
+
+                            seconds = 5 * 3600 + t * (19 * 3600 // departures) + rng.randrange(0, 180) * (p > 0)
+                            for i, s in enumerate(sequence):
+                                if i:
+                                    seconds += rng.randrange(90, 180)
+                                time_str = f'{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}'
+                                writer.writerow([trip_id, time_str, time_str, f'H{s}' if s in hubs else f'S{r}_{s}', i + 1])
+            stop_times.flush()
+            stop_times.detach()
+
+        _table(z, 'trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'direction_id'], trip_rows)
+
+
+def generate_template(path):
+    document = Document()
+    document.sections[0].header.paragraphs[0].text = 'Ligne {{ route }} - {{ stop }}'
+    document.add_paragraph('Arrêt {{ stop }} direction {{ direction }}')
+    document.add_paragraph('[TABLE_PLACEHOLDER]')
+    document.add_paragraph('Légende')
+    document.add_paragraph('[LEGEND_PLACEHOLDER]')
+    document.sections[0].footer.paragraphs[0].text = 'Ligne {{ route }}'
+    document.save(path)
+
+
+def add_feed_arguments(parser):
+    parser.add_argument('--routes', type=int, default=10, help="number of routes (default: 10)")
+    parser.add_argument('--stops', type=int, default=20, help="stops per route (default: 20)")
+    parser.add_argument('--trips', type=int, default=60, help="weekday trips per route and direction (default: 60)")
+    parser.add_argument('--patterns', type=int, default=4, help=f"distinct service patterns, at most {len(WEEKDAY_SETS)} (default: 4)")
+    parser.add_argument('--headsigns', type=int, default=2, help="headsigns per route and direction (default: 2)")
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def feed_parameters(args):
+    return {'routes': args.routes, 'stops': args.stops, 'trips': args.trips, 'patterns': args.patterns, 'headsigns': args.headsigns, 'seed': args.seed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic GTFS feed.")
+    parser.add_argument('output', help="path of the GTFS zip to write")
+    parser.add_argument('--template', help="also write a Word template to this path")
+    add_feed_arguments(parser)
+    args = parser.parse_args()
+    generate_feed(args.output, **feed_parameters(args))
+    if args.template:
+        generate_template(args.template)
@@ -0,0 +1,163 @@
+import copy
+import io
+import re
+import zipfile
+from lxml import etree
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+FIELD_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+JINJA_PATTERN = re.compile(r'\{[{%#]')
+PART_PATTERN = re.compile(r'^word/(document|header\d*|footer\d*)\.xml$')
+
+
+def w(tag):
+    return f'{{{W_NS}}}{tag}'
+
+
+def paragraph_text(paragraph):
+    return ''.join(t.text or '' for t in paragraph.iter(w('t')))
+
+
+def element_path(element):
+    path = []
+    while element.getparent() is not None:
+        parent = element.getparent()
+        path.append(parent.index(element))
+        element = parent
+    return path[::-1]
+
+
+def resolve_path(root, path):
+    element = root
+    for index in path:
+        element = element[index]
+    return element
+
+
+class UnsupportedTemplateError(ValueError):
+    pass
+
+
+class CompiledTemplate:
+    """A Word template parsed once and rendered per stop without re-parsing.
+
+    Compiling locates the ``{{ field }}`` paragraphs and the placeholder
+    paragraphs of the body, headers and footers. Rendering deep-copies only the
+    parts that contain them, substitutes in place and zips the result with the
+    untouched parts copied over as bytes. Templates using Jinja constructs
+    beyond plain ``{{ name }}`` fields raise UnsupportedTemplateError.
+    """
+
+    def __init__(self, template_bytes, placeholders=('[TABLE_PLACEHOLDER]', '[LEGEND_PLACEHOLDER]')):
+        self.placeholders = placeholders
+        self.entries = []
+        self.parts = {}
+
+        with zipfile.ZipFile(io.BytesIO(template_bytes)) as z:
+            for info in z.infolist():
+                data = z.read(info)
+                self.entries.append((info, data))
+                if PART_PATTERN.match(info.filename):
+                    part = self._compile_part(data)
+                    if part is not None:
+                        self.parts[info.filename] = part
+
+    def _compile_part(self, data):
+        root = etree.fromstring(data)
+        field_paths = []
+        for paragraph in root.iter(w('p')):
+            text = paragraph_text(paragraph)
+            if not JINJA_PATTERN.search(text):
+                continue
+            if JINJA_PATTERN.search(FIELD_PATTERN.sub('', text)):
+                raise UnsupportedTemplateError(f"Unsupported template expression in paragraph: {text!r}")
+            field_paths.append(element_path(paragraph))
+
+        # Like python-docx's doc.paragraphs, placeholders are only looked up
+        # among the direct children of the body, headers and footers
+        container = root.find(w('body')) if root.tag == w('document') else root
+        placeholder_paths = {placeholder: [] for placeholder in self.placeholders}
+        for paragraph in container.iterchildren(w('p')):
+            text = paragraph_text(paragraph)
+            for placeholder in self.placeholders:
+                if placeholder in text:
+                    placeholder_paths[placeholder].append(element_path(paragraph))
+
+        if not field_paths and not any(placeholder_paths.values()):
+            return None
+        return root, field_paths, placeholder_paths
+
+    def render(self, context, elements_by_placeholder=None):
+        elements_by_placeholder = elements_by_placeholder or {}
+        rendered_parts = {}
+        for name, (root, field_paths, placeholder_paths) in self.parts.items():
+            root = copy.deepcopy(root)
+            # Resolve every path before the tree is modified
+            field_paragraphs = [resolve_path(root, path) for path in field_paths]
+            placeholder_paragraphs = {
+                placeholder: [resolve_path(root, path) for path in paths]
+                for placeholder, paths in placeholder_paths.items()
+            }
+
+            for paragraph in field_paragraphs:
+                substitute_fields(paragraph, context)
+
+            for placeholder, paragraphs in placeholder_paragraphs.items():
+                elements = elements_by_placeholder.get(placeholder, [])
+                for paragraph in paragraphs:
+                    for element in elements:
+                        paragraph.addprevious(copy.deepcopy(getattr(element, '_element', element)))
+                    for child in list(paragraph):
+                        if child.tag != w('pPr'):
+                            paragraph.remove(child)
+
+            rendered_parts[name] = etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+        output_buffer = io.BytesIO()
+        with zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+            for info, data in self.entries:
+                z.writestr(info.filename, rendered_parts.get(info.filename, data), compress_type=zipfile.ZIP_DEFLATED)
+        output_buffer.seek(0)
+        return output_buffer
+
+
+def substitute_fields(paragraph, context):
+    text_nodes = [t for t in paragraph.iter(w('t'))]
+    texts = [t.text or '' for t in text_nodes]
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text)
+    joined = ''.join(texts)
+
+    # Replace from the end so earlier offsets stay valid. A field split over
+    # several runs is written into its first run, keeping that run's formatting
+    for match in reversed(list(FIELD_PATTERN.finditer(joined))):
+        value = context.get(match.group(1), '')
+        value = '' if value is None else str(value)
+        first = last = None
+        for i, start in enumerate(starts):
+            end = start + len(texts[i])
+            if first is None and match.start() < end:
+                first = i
+            if match.end() <= end:
+                last = i
+                break
+        head = texts[first][:match.start() - starts[first]]
+        tail = texts[last][match.end() - starts[last]:]
+        if first == last:
+            texts[first] = head + value + tail
+        else:
+            texts[first] = head + value
+            for i in range(first + 1, last):
+                texts[i] = ''
+            texts[last] = tail
+
+    for node, text in zip(text_nodes, texts):
+        if node.text != text:
+            node.text = text
+            if text != text.strip():
+                node.set(XML_SPACE, 'preserve')
@@ -0,0 +1,497 @@
+import io
+import os
+import re
+import sys
+import copy
+import contextlib
+import hashlib
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing
+from docxtpl import DocxTemplate
+from docx import Document
+from lxml import etree
+from xml.sax.saxutils import escape
+import compiled_template
+import utils
+from utils import partition_timetable_by_stop, organize_times_by_hour, source_digest
+from compiled_template import CompiledTemplate, UnsupportedTemplateError, W_NS
+from manifest import stop_fingerprint, template_digest
+from profiling import profile_stage
+
+HEADSIGN_COLORS = {
+    1: 'FFFFFC',
+    2: 'BED5FF',
+    3: 'FEDAAA',
+    4: 'BFFBB7',
+    5: 'FFC6FF',
+    6: 'FFFE88',
+    7: 'D9D5FF',
+    8: 'FFC8C8',
+    9: 'A3F6FE'
+}
+
+NSDECL = f'xmlns:w="{W_NS}"'
+
+DEFAULT_WORKERS = int(os.environ.get('STOP_PI_WORKERS', 1))
+ARCHIVE_SPOOL_BYTES = int(os.environ.get('STOP_PI_ARCHIVE_SPOOL_BYTES', 16 * 1024 ** 2))
+FRAGMENT_CACHE_ENTRIES = int(os.environ.get('STOP_PI_FRAGMENT_CACHE_ENTRIES', 256))
+
+# Goes into every stop fingerprint, so that changing the code or libraries that
+# lay documents out stops earlier manifests from reusing their documents
+LAYOUT_VERSION = '-'.join([
+    source_digest(sys.modules[__name__], compiled_template, utils),
+    *(f"{package}{metadata.version(package)}" for package in ('python-docx', 'docxtpl', 'lxml')),
+])
+
+def sanitize_filename(filename):
+    return re.sub(r'[\\/*?:"<>|]', "_", filename)
+
+# Tables are written as WordprocessingML strings and parsed once, instead of
+# being built cell by cell through python-docx. Borders live in the table
+# properties; cells only carry the few tcPr variants defined below.
+BLOCK_WIDTH = 8640  # twips, the text width python-docx gives new tables
+LEGEND_SWATCH_WIDTH = 425  # twips, 0.75 cm
+
+def _border(side, size, val='single'):
+    return f'<w:{side} w:val="{val}" w:sz="{size}" w:space="0" w:color="000000"/>'
+
+TIMETABLE_BORDERS = (
+    '<w:tblBorders>'
+    + _border('top', 12) + _border('left', 12) + _border('bottom', 12) + _border('right', 12)
+    + _border('insideH', 0, 'none') + _border('insideV', 6)
+    + '</w:tblBorders>'
+)
+
+# Header cells keep the thick rule under the header and no inner verticals
+HEADER_CELL_BORDERS = {
+    (True, True): _border('bottom', 12),
+    (True, False): _border('bottom', 12) + _border('right', 0, 'nil'),
+    (False, True): _border('left', 0, 'nil') + _border('bottom', 12),
+    (False, False): _border('left', 0, 'nil') + _border('bottom', 12) + _border('right', 0, 'nil'),
+}
+
+LEGEND_SWATCH_BORDERS = _border('top', 6) + _border('left', 6) + _border('bottom', 6) + _border('right', 6)
+
+def _shading(color):
+    return f'<w:shd w:val="clear" w:color="auto" w:fill="{color}"/>' if color else ''
+
+def _table_xml(rows_xml, column_widths, alignment, borders=''):
+    grid = ''.join(f'<w:gridCol w:w="{width}"/>' for width in column_widths)
+    return (
+        f'<w:tbl {NSDECL}><w:tblPr><w:tblW w:w="0" w:type="auto"/><w:jc w:val="{alignment}"/>{borders}'
+        '<w:tblLook w:val="04A0" w:firstRow="1" w:lastRow="0" w:firstColumn="1" w:lastColumn="0" w:noHBand="0" w:noVBand="1"/>'
+        f'</w:tblPr><w:tblGrid>{grid}</w:tblGrid>{rows_xml}</w:tbl>'
+    )
+
+def _cell_xml(tc_pr, p_pr, text, r_pr=''):
+    run = f'<w:r>{r_pr}<w:t xml:space="preserve">{escape(text)}</w:t></w:r>' if text else (f'<w:r>{r_pr}</w:r>' if r_pr else '')
+    return f'<w:tc><w:tcPr>{tc_pr}</w:tcPr><w:p><w:pPr>{p_pr}</w:pPr>{run}</w:p></w:tc>'
+
+def create_styled_table(dataframe, headsign_colors=None, headsign_index_map=None):
+    num_columns = len(dataframe.columns)
+    column_width = BLOCK_WIDTH // max(num_columns, 1)
+    font_size = max(12 - (num_columns // 5), 6)
+    header_font_size = max(12 - (num_columns // 5) - 1, 6)
+
+    width = f'<w:tcW w:w="{column_width}" w:type="dxa"/>'
+    v_align = '<w:vAlign w:val="center"/>'
+    header_r_pr = f'<w:rPr><w:b/><w:sz w:val="{header_font_size * 2}"/></w:rPr>'
+    body_r_pr = f'<w:rPr><w:sz w:val="{font_size * 2}"/></w:rPr>'
+    keep_centered = '<w:keepNext/><w:jc w:val="center"/>'
+    centered = '<w:jc w:val="center"/>'
+    body_tc_pr = {}
+
+    parts = ['<w:tr>']
+    for i, col_name in enumerate(dataframe.columns):
+        borders = HEADER_CELL_BORDERS[(i == 0, i == num_columns - 1)]
+        tc_pr = f'{width}<w:tcBorders>{borders}</w:tcBorders>{_shading("E3EAEE")}{v_align}'
+        parts.append(_cell_xml(tc_pr, keep_centered, str(col_name), header_r_pr))
+    parts.append('</w:tr>')
+
+    colors = None
+    if headsign_index_map is not None and headsign_colors is not None:
+        colors = [[headsign_colors.get(index) if not isinstance(index, str) else None for index in row] for row in headsign_index_map.values.tolist()]
+
+    values = dataframe.values.tolist()
+    num_rows = len(values)
+    for row_index, row_data in enumerate(values):
+        p_pr = keep_centered if row_index < num_rows - 1 else centered
+        parts.append('<w:tr>')
+        for col_index, val in enumerate(row_data):
+            color = colors[row_index][col_index] if colors is not None else None
+            if color not in body_tc_pr:
+                body_tc_pr[color] = width + _shading(color) + v_align
+            parts.append(_cell_xml(body_tc_pr[color], p_pr, str(val), body_r_pr))
+        parts.append('</w:tr>')
+
+    return etree.fromstring(_table_xml(''.join(parts), [column_width] * num_columns, 'center', TIMETABLE_BORDERS))
+
+def create_legend_table(headsign_colors, headsign_index_dict):
+    parts = []
+    for key in sorted(headsign_index_dict.keys()):
+        if key == 1:
+            continue
+        if key in headsign_colors:
+            swatch_tc_pr = f'<w:tcW w:w="{LEGEND_SWATCH_WIDTH}" w:type="dxa"/><w:tcBorders>{LEGEND_SWATCH_BORDERS}</w:tcBorders>{_shading(headsign_colors[key])}'
+            parts.append('<w:tr>')
+            parts.append(f'<w:tc><w:tcPr>{swatch_tc_pr}</w:tcPr><w:p/></w:tc>')
+            parts.append(_cell_xml(f'<w:tcW w:w="{BLOCK_WIDTH // 2}" w:type="dxa"/>', '<w:jc w:val="left"/>', str(headsign_index_dict[key])))
+            parts.append('</w:tr>')
+    return etree.fromstring(_table_xml(''.join(parts), [BLOCK_WIDTH // 2] * 2, 'left'))
+
+class FragmentCache:
+    """Bounded LRU of table elements, keyed by a hash of what the table shows.
+
+    Neighbouring stops often share an hour grid or a legend, so the XML is
+    built and parsed once. Cached elements are shared and never modified:
+    templates insert deep copies of them.
+    """
+
+    def __init__(self, max_entries=FRAGMENT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, create):
+        return self.lookup(key, create)[0]
+
+    def lookup(self, key, create):
+        # Returns the element and whether it was already cached
+        with self._lock:
+            element = self._entries.get(key)
+            if element is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return element, True
+            self.misses += 1
+        element = create()
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = element
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return element, False
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+class FragmentCounter:
+    """Hits and misses of one caller on a shared FragmentCache.
+
+    The cache's own totals mix every session and run that used it; a run
+    wraps the cache in a counter to report only its own lookups.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_create(self, key, create):
+        element, hit = self.cache.lookup(key, create)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return element
+
+FRAGMENT_CACHE = FragmentCache()
+
+def _fragment_key(kind, *parts):
+    h = hashlib.blake2b(kind.encode('utf-8'), digest_size=16)
+    for part in parts:
+        h.update(b'\x1e')
+        h.update(part.encode('utf-8'))
+    return h.digest()
+
+def _grid_text(dataframe):
+    return '\x1d'.join([
+        '\x1f'.join(map(str, dataframe.columns)),
+        *('\x1f'.join(map(str, row)) for row in dataframe.values.tolist()),
+    ])
+
+def cached_styled_table(dataframe, headsign_colors, headsign_index_map, cache=FRAGMENT_CACHE):
+    key = _fragment_key('table', _grid_text(dataframe), _grid_text(headsign_index_map), repr(sorted(headsign_colors.items())))
+    return cache.get_or_create(key, lambda: create_styled_table(dataframe, headsign_colors, headsign_index_map))
+
+def cached_legend_table(headsign_colors, headsign_index_dict, cache=FRAGMENT_CACHE):
+    key = _fragment_key('legend', repr(sorted(headsign_index_dict.items())), repr(sorted(headsign_colors.items())))
+    return cache.get_or_create(key, lambda: create_legend_table(headsign_colors, headsign_index_dict))
+
+def insert_elements_at_placeholders(doc, elements, placeholder):
+    placeholder_locs = []
+
+    for paragraph in doc.paragraphs:
+        if placeholder in paragraph.text:
+            placeholder_locs.append(paragraph)
+    
+    for section in doc.sections:
+        for header_footer in [section.header, section.footer]:
+            for paragraph in header_footer.paragraphs:
+                if placeholder in paragraph.text:
+                    placeholder_locs.append(paragraph)
+
+    for placeholder_paragraph in placeholder_locs:
+        parent = placeholder_paragraph._element.getparent()
+        idx = parent.index(placeholder_paragraph._element)
+        placeholder_paragraph.clear()
+        for element in elements:
+            parent.insert(idx, copy.deepcopy(getattr(element, '_element', element)))
+            idx += 1
+
+class DocxtplTemplate:
+    """Fallback for templates CompiledTemplate cannot handle: full docxtpl
+    rendering, re-parsed with python-docx, for every document."""
+
+    def __init__(self, template_bytes):
+        self.template_bytes = template_bytes
+
+    def render(self, context, elements_by_placeholder=None):
+        doc = DocxTemplate(io.BytesIO(self.template_bytes))
+        doc.render(context)
+
+        doc_buffer = io.BytesIO()
+        doc.save(doc_buffer)
+        doc_buffer.seek(0)
+
+        rendered_doc = Document(doc_buffer)
+        for placeholder, elements in (elements_by_placeholder or {}).items():
+            insert_elements_at_placeholders(rendered_doc, elements, placeholder)
+
+        output_buffer = io.BytesIO()
+        rendered_doc.save(output_buffer)
+        output_buffer.seek(0)
+        return output_buffer
+
+def compile_template(template_bytes):
+    try:
+        return CompiledTemplate(template_bytes)
+    except UnsupportedTemplateError:
+        return DocxtplTemplate(template_bytes)
+
+def stop_tables(grouped_timetables):
+    # All a stop's document shows of each group's timetable; workers get only this
+    return {
+        group_name: (group_timetable['arrival_seconds'].to_numpy(), group_timetable['headsign_index'].to_numpy())
+        for group_name, (dates, group_timetable) in grouped_timetables.items()
+    }
+
+def render_stop_document(tables, context, stop_headsign_index_dict, template, fragment_cache=FRAGMENT_CACHE):
+    elements = []
+    for group_name, (arrival_seconds, headsign_indices) in tables.items():
+        group_title = create_title(group_name)
+        organized_timetable, organized_headsign_index = organize_times_by_hour(arrival_seconds, headsign_indices)
+        table = cached_styled_table(organized_timetable, HEADSIGN_COLORS, organized_headsign_index, fragment_cache)
+        elements.append(group_title)
+        elements.append(table)
+
+    legend_table = cached_legend_table(HEADSIGN_COLORS, stop_headsign_index_dict, fragment_cache)
+    return template.render(context, {'[TABLE_PLACEHOLDER]': elements, '[LEGEND_PLACEHOLDER]': [legend_table]})
+
+def create_document_executor(workers):
+    """Process pool for generate_word_documents, meant to be reused across routes.
+
+    Spawned workers import pandas, lxml and python-docx once and keep the
+    templates they compiled, so only the first route pays for starting them.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+@contextlib.contextmanager
+def _worker_template_file(template_bytes):
+    # Tasks carry the template's path rather than its bytes; a worker reads it
+    # only the first time it sees the template
+    fd, path = tempfile.mkstemp(prefix='stop_pi_template.', suffix='.docx')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(template_bytes)
+        yield path
+    finally:
+        os.remove(path)
+
+WORKER_TEMPLATES = 4
+_worker_templates = OrderedDict()
+
+def _worker_template(template_hash, template_path):
+    template = _worker_templates.pop(template_hash, None)
+    if template is None:
+        with open(template_path, 'rb') as f:
+            template = compile_template(f.read())
+    _worker_templates[template_hash] = template
+    while len(_worker_templates) > WORKER_TEMPLATES:
+        _worker_templates.popitem(last=False)
+    return template
+
+def _render_stop_document_in_worker(template_hash, template_path, tables, context, stop_headsign_index_dict):
+    # The render time and the document's fragment cache hits and misses travel back with it
+    start = time.perf_counter()
+    fragments = FragmentCounter(FRAGMENT_CACHE)
+    doc_buffer = render_stop_document(tables, context, stop_headsign_index_dict, _worker_template(template_hash, template_path), fragments)
+    return doc_buffer, time.perf_counter() - start, fragments.hits, fragments.misses
+
+def read_template_bytes(template_file):
+    if isinstance(template_file, (bytes, bytearray)):
+        return bytes(template_file)
+    if isinstance(template_file, (str, os.PathLike)):
+        with open(template_file, 'rb') as f:
+            return f.read()
+    if hasattr(template_file, 'getvalue'):
+        return template_file.getvalue()
+    template_file.seek(0)
+    return template_file.read()
+
+def generate_word_documents(timetable, pattern_dates, route_id, feed, headsign_index_dict, status_container, template_file, workers=None, archive=None, previous=None, manifest=None, stats=None, profile=None, fragment_cache=None, executor=None):
+    route_short_name = feed.routes[feed.routes['route_id'] == route_id]['route_short_name'].values[0]
+    template_bytes = read_template_bytes(template_file)
+    template_hash = template_digest(template_bytes)
+    workers = workers or DEFAULT_WORKERS
+
+    with profile_stage(profile, 'group_dates_by_timetables', rows=len(timetable)):
+        partitions = partition_timetable_by_stop(timetable, pattern_dates, feed.stops, headsign_index_dict)
+
+    stop_jobs = []
+    with profile_stage(profile, 'fingerprint_stops', rows=len(partitions)):
+        for stop_id, stop in partitions.items():
+            context = {
+                'route': route_short_name,
+                'stop': stop.stop_name,
+                'direction': stop.direction
+            }
+            doc_filename = sanitize_filename(f"{route_id}_{stop_id}.docx")
+            fingerprint = stop_fingerprint(stop.grouped_timetables, context, stop.headsigns, template_hash, HEADSIGN_COLORS, LAYOUT_VERSION)
+            stop_jobs.append((doc_filename, (stop_tables(stop.grouped_timetables), context, stop.headsigns), stop_id, fingerprint))
+
+    num_stops = len(stop_jobs)
+    doc_buffers = [None] * num_stops
+    next_to_write = 0
+
+    def collect(i, doc_buffer):
+        # With an archive, documents are written in stop order as soon as all
+        # earlier ones are done, and their buffers dropped right away
+        nonlocal next_to_write
+        doc_buffers[i] = doc_buffer
+        if archive is None:
+            return
+        while next_to_write < num_stops and doc_buffers[next_to_write] is not None:
+            archive.add(stop_jobs[next_to_write][0], doc_buffers[next_to_write])
+            doc_buffers[next_to_write] = True
+            next_to_write += 1
+
+    # Stops whose fingerprint matches the previous run take its document as is
+    to_render = []
+    with profile_stage(profile, 'reuse_unchanged_stops', rows=num_stops):
+        for i, (doc_filename, _, stop_id, fingerprint) in enumerate(stop_jobs):
+            doc_buffer = previous.reuse(doc_filename, fingerprint) if previous is not None else None
+            if manifest is not None:
+                manifest.add(doc_filename, stop_id, fingerprint, reused=doc_buffer is not None)
+            if doc_buffer is None:
+                to_render.append(i)
+            else:
+                collect(i, doc_buffer)
+    num_reused = num_stops - len(to_render)
+
+    template = None
+    # fragment_cache applies to serial rendering; worker processes keep their own
+    fragments = FragmentCounter(FRAGMENT_CACHE if fragment_cache is None else fragment_cache)
+    with profile_stage(profile, 'render_documents', rows=len(to_render)):
+        if (executor is not None or workers > 1) and len(to_render) > 1:
+            # Workers get the template's path and one stop's arrival times and headsign
+            # indices per task, with at most `workers` tasks in flight so a shared
+            # executor is not taken over by one call. Results are slotted back by
+            # index so the output order is deterministic
+            with contextlib.ExitStack() as stack:
+                if executor is None:
+                    executor = stack.enter_context(create_document_executor(min(workers, len(to_render))))
+                template_path = stack.enter_context(_worker_template_file(template_bytes))
+                waiting = iter(to_render)
+                futures = {}
+
+                def submit_next():
+                    i = next(waiting, None)
+                    if i is not None:
+                        futures[executor.submit(_render_stop_document_in_worker, template_hash, template_path, *stop_jobs[i][1])] = i
+
+                # On failure, a shared executor must not go on with this call's tasks
+                stack.callback(lambda: [future.cancel() for future in futures])
+                for _ in range(workers):
+                    submit_next()
+                done = num_reused
+                while futures:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        i = futures.pop(future)
+                        doc_buffer, seconds, hits, misses = future.result()
+                        submit_next()
+                        fragments.hits += hits
+                        fragments.misses += misses
+                        if profile is not None:
+                            profile.record_stop(stop_jobs[i][0], seconds)
+                        collect(i, doc_buffer)
+                        done += 1
+                        status_container.update(label=f"Processed {done} of {num_stops} stops", state="running")
+        else:
+            template = compile_template(template_bytes) if to_render else None
+            for done, i in enumerate(to_render, start=num_reused + 1):
+                start = time.perf_counter()
+                doc_buffer = render_stop_document(*stop_jobs[i][1], template, fragments)
+                if profile is not None:
+                    profile.record_stop(stop_jobs[i][0], time.perf_counter() - start)
+                collect(i, doc_buffer)
+                status_container.update(label=f"Processed {done} of {num_stops} stops", state="running")
+
+    if profile is not None and profile.profile_slowest_stop and to_render:
+        # Rendered again in this process, with a private fragment cache so it does the full work
+        slowest = max(to_render, key=lambda i: profile.stop_seconds.get(stop_jobs[i][0], 0))
+        template = template or compile_template(template_bytes)
+        profile.capture_slowest_stop(lambda: render_stop_document(*stop_jobs[slowest][1], template, FragmentCache(0)), stop_jobs[slowest][0])
+
+    if stats is not None:
+        stats.update(rendered=len(to_render), reused=num_reused, fragment_hits=fragments.hits, fragment_misses=fragments.misses)
+
+    if num_reused:
+        status_container.update(label=f"All documents have been processed successfully! ({len(to_render)} rendered, {num_reused} unchanged)", state="complete")
+    else:
+        status_container.update(label="All documents have been processed successfully!", state="complete")
+
+    if archive is not None:
+        return [doc_filename for doc_filename, *_ in stop_jobs]
+    return [(doc_filename, doc_buffer) for (doc_filename, *_), doc_buffer in zip(stop_jobs, doc_buffers)]
+
+def create_title(text):
+    return etree.fromstring(
+        f'<w:p {NSDECL}><w:pPr><w:pStyle w:val="Heading2"/><w:keepNext/><w:jc w:val="left"/></w:pPr>'
+        f'<w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>'
+    )
+
+class DocumentArchive:
+    """Deflate-compressed zip written one document at a time.
+
+    The archive lives in a SpooledTemporaryFile, so it only stays in memory
+    while smaller than max_memory and is otherwise served from disk.
+    """
+
+    def __init__(self, max_memory=ARCHIVE_SPOOL_BYTES):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory, suffix='.zip')
+        self._zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, doc_filename, doc_buffer):
+        self._zip.writestr(doc_filename, doc_buffer.getvalue())
+        doc_buffer.close()
+
+    def close(self):
+        self._zip.close()
+        self.file.seek(0)
+        return self.file
+
+def create_zip_file(doc_files):
+    archive = DocumentArchive()
+    for doc_file, buffer in doc_files:
+        archive.add(doc_file, buffer)
+    return archive.close()
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import gtfs_kit as gk
+import pandas as pd
+import lean_feed
+from lean_feed import read_lean_feed
+from utils import source_digest
+
+DEFAULT_CACHE_DIR = os.environ.get('STOP_PI_FEED_CACHE', os.path.join(tempfile.gettempdir(), 'stop_pi_feed_cache'))
+DEFAULT_MAX_BYTES = int(os.environ.get('STOP_PI_FEED_CACHE_BYTES', 2 * 1024 ** 3))
+
+FEED_TABLES = list(gk.constants.DTYPES.keys())
+
+# Bumped when the layout of cache entries changes. Entries are also only valid
+# for the code and library versions that wrote them: the lean loader's source
+# (its columns, dtypes and id cleaning), gtfs_kit for full feeds, and pandas
+CACHE_FORMAT_VERSION = 1
+LEAN_FORMAT = f"v{CACHE_FORMAT_VERSION}-lean-{source_digest(lean_feed)}-pandas{pd.__version__}"
+FULL_FORMAT = f"v{CACHE_FORMAT_VERSION}-gtfs_kit{gk.__version__}-pandas{pd.__version__}"
+
+
+def feed_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FeedCache:
+    """On-disk cache of cleaned GTFS feeds, keyed by the hash of the uploaded zip.
+
+    Each entry is a directory holding one parquet file per feed table. Entries
+    are evicted least recently used first once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def get(self, digest):
+        entry_dir = self._entry_dir(digest)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            tables = {table: pd.read_parquet(os.path.join(entry_dir, f"{table}.parquet")) for table in meta['tables']}
+        except (OSError, ValueError):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        # Touch the entry so it counts as recently used for eviction
+        os.utime(entry_dir)
+        return gk.Feed(dist_units=meta['dist_units'], **tables)
+
+    def put(self, digest, feed):
+        entry_dir = self._entry_dir(digest)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{digest}.", dir=self.cache_dir)
+        try:
+            tables = []
+            for table in FEED_TABLES:
+                df = getattr(feed, table)
+                if df is None:
+                    continue
+                df.reset_index(drop=True).to_parquet(os.path.join(tmp_dir, f"{table}.parquet"), index=False)
+                tables.append(table)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump({'dist_units': feed.dist_units, 'tables': tables}, f)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # Another session stored the same feed first
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def load(self, data, digest=None, dist_units='km', lean=False):
+        digest = digest or feed_digest(data)
+        # Lean and full feeds hold different tables, so they are cached apart
+        entry_key = f"{digest}-{LEAN_FORMAT if lean else FULL_FORMAT}-{dist_units}"
+        feed = self.get(entry_key)
+        if feed is not None:
+            return feed
+
+        if lean:
+            feed = read_lean_feed(data, dist_units=dist_units)
+        else:
+            tmp = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+            try:
+                with tmp:
+                    tmp.write(data)
+                feed = gk.read_feed(tmp.name, dist_units=dist_units).clean()
+            finally:
+                os.remove(tmp.name)
+
+        self.put(entry_key, feed)
+        return feed
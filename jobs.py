@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_CONCURRENT_JOBS = int(os.environ.get('STOP_PI_MAX_JOBS', 2))
+MAX_QUEUED_JOBS = int(os.environ.get('STOP_PI_MAX_QUEUED_JOBS', 8))
+JOB_RETENTION_SECONDS = int(os.environ.get('STOP_PI_JOB_RETENTION', 3600))
+MAX_RETAINED_JOBS = int(os.environ.get('STOP_PI_MAX_RETAINED_JOBS', 32))
+
+QUEUED, RUNNING, COMPLETE, ERROR = 'queued', 'running', 'complete', 'error'
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class Job:
+    """One submitted generation, polled by the sessions waiting on it.
+
+    Jobs double as the status container handed to generate_word_documents:
+    update() records the latest progress label, while the runner alone moves
+    the job between states.
+    """
+
+    def __init__(self, job_id, key):
+        self.id = job_id
+        self.key = key
+        self.state = QUEUED
+        self.label = "Waiting for a free worker..."
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.state in (COMPLETE, ERROR)
+
+    def update(self, label=None, state=None, **kwargs):
+        if label is not None:
+            self.label = label
+
+    def has(self, name):
+        """Whether the result file name is still there to read; cheap, unlike read().
+
+        Results may hold spooled files shared by every session downloading
+        them; the runner closes them when it drops the job, even while a
+        session still holds it.
+        """
+        result_file = (self.result or {}).get(name)
+        return result_file is not None and not result_file.closed
+
+    def read(self, name):
+        """Contents of the result file name, or None once the job has expired."""
+        with self._lock:
+            if not self.has(name):
+                return None
+            result_file = self.result[name]
+            result_file.seek(0)
+            return result_file.read()
+
+    def close(self):
+        with self._lock:
+            for value in (self.result or {}).values():
+                if hasattr(value, 'close'):
+                    value.close()
+
+
+class JobRunner:
+    """Bounded background runner for generation jobs, shared by every session.
+
+    At most max_concurrent jobs run at once and at most max_queued wait;
+    submitting beyond that raises QueueFullError. Jobs are deduplicated on
+    their key, so identical requests share one run and its result. Finished
+    jobs are kept for retention seconds, up to max_retained of them.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS,
+                 retention=JOB_RETENTION_SECONDS, max_retained=MAX_RETAINED_JOBS):
+        self.max_queued = max_queued
+        self.retention = retention
+        self.max_retained = max_retained
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='stop-pi-job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._jobs_by_key = {}
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Run fn(job, *args, **kwargs) in the background, returning its Job.
+
+        fn's return value becomes job.result. A queued, running or retained
+        job with the same key is returned instead of starting a new one;
+        failed jobs are retried.
+        """
+        with self._lock:
+            self._prune()
+            job = self._jobs_by_key.get(key)
+            if job is not None and job.state != ERROR:
+                return job
+            if sum(1 for queued in self._jobs.values() if queued.state == QUEUED) >= self.max_queued:
+                raise QueueFullError("Too many timetable requests are waiting, please try again in a moment.")
+            job = Job(uuid.uuid4().hex, key)
+            self._jobs[job.id] = job
+            self._jobs_by_key[key] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args, kwargs):
+        job.state = RUNNING
+        job.label = "Fetching timetable data..."
+        try:
+            job.result = fn(job, *args, **kwargs)
+            state = COMPLETE
+        except Exception as e:
+            job.error = e
+            job.label = f"Generation failed: {e}"
+            state = ERROR
+        # finished_at goes first: done jobs are pruned by it
+        job.finished_at = time.time()
+        job.state = state
+
+    def _prune(self):
+        now = time.time()
+        finished = sorted((job for job in self._jobs.values() if job.done), key=lambda job: job.finished_at)
+        expired = [job for job in finished if now - job.finished_at > self.retention]
+        expired += [job for job in finished[:max(len(finished) - self.max_retained, 0)] if job not in expired]
+        for job in expired:
+            del self._jobs[job.id]
+            if self._jobs_by_key.get(job.key) is job:
+                del self._jobs_by_key[job.key]
+            job.close()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
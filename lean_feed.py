@@ -0,0 +1,113 @@
+import io
+import pathlib
+import zipfile
+import gtfs_kit as gk
+import pandas as pd
+
+STRING = 'string[pyarrow]'
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# The only tables and columns the timetable generator reads
+LEAN_COLUMNS = {
+    'routes': {
+        'route_id': STRING,
+        'route_short_name': STRING,
+        'route_long_name': STRING,
+        'route_color': STRING,
+        'route_text_color': STRING,
+    },
+    'trips': {
+        'route_id': STRING,
+        'service_id': STRING,
+        'trip_id': STRING,
+        'trip_headsign': STRING,
+    },
+    'stops': {
+        'stop_id': STRING,
+        'stop_name': STRING,
+    },
+    'stop_times': {
+        'trip_id': STRING,
+        'arrival_time': STRING,
+        'stop_id': STRING,
+        'stop_sequence': 'Int32',
+    },
+    'calendar': {
+        'service_id': STRING,
+        **{day: 'Int8' for day in WEEKDAYS},
+        'start_date': STRING,
+        'end_date': STRING,
+    },
+    'calendar_dates': {
+        'service_id': STRING,
+        'date': STRING,
+        'exception_type': 'Int8',
+    },
+}
+
+CSV_OPTIONS = {
+    'na_values': ['', ' ', 'nan', 'NaN', 'null'],
+    'keep_default_na': True,
+    'encoding': 'utf-8-sig',
+}
+
+
+def read_lean_table(zf, member, columns):
+    # Column names may carry stray whitespace, so map the raw header first
+    with zf.open(member) as f:
+        header = pd.read_csv(f, nrows=0, encoding='utf-8-sig').columns
+    raw_names = {name: name.strip() for name in header if name.strip() in columns}
+
+    with zf.open(member) as f:
+        df = pd.read_csv(
+            f,
+            usecols=list(raw_names),
+            dtype={name: columns[stripped] for name, stripped in raw_names.items()},
+            **CSV_OPTIONS,
+        )
+    df = df.rename(columns=raw_names)
+    for column, dtype in columns.items():
+        if column not in df.columns:
+            df[column] = pd.Series(pd.NA, index=df.index, dtype=dtype)
+    return df[list(columns)]
+
+
+def clean_lean_ids(df):
+    for column in df.columns:
+        if column.endswith('_id') and df[column].str.contains(r'\s', regex=True).any():
+            df[column] = df[column].str.strip().str.replace(r'\s+', '_', regex=True)
+    return df
+
+
+def clean_lean_route_short_names(routes):
+    # Same rules as gtfs_kit's clean_route_short_names, without copying the feed
+    routes['route_short_name'] = routes['route_short_name'].fillna('n/a').str.strip()
+    duplicated = routes['route_short_name'].duplicated(keep=False)
+    routes.loc[duplicated, 'route_short_name'] = routes.loc[duplicated, 'route_short_name'] + '-' + routes.loc[duplicated, 'route_id']
+    return routes
+
+
+def read_lean_feed(source, dist_units='km'):
+    """Read only the tables and columns in LEAN_COLUMNS straight from a GTFS zip.
+
+    ``source`` is a path, bytes or a binary file object. Only the cleaning the
+    timetable path relies on is applied: ids are normalised like
+    gtfs_kit's clean_ids and route short names like clean_route_short_names.
+    Arrival times are left as read, since they are parsed to seconds later.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    tables = {}
+    with zipfile.ZipFile(source) as zf:
+        for info in zf.infolist():
+            table = pathlib.PurePosixPath(info.filename).stem
+            if info.is_dir() or not info.file_size or not info.filename.endswith('.txt') or table not in LEAN_COLUMNS:
+                continue
+            df = read_lean_table(zf, info, LEAN_COLUMNS[table])
+            if not df.empty:
+                tables[table] = clean_lean_ids(df)
+
+    if 'routes' in tables:
+        tables['routes'] = clean_lean_route_short_names(tables['routes'])
+    return gk.Feed(dist_units=dist_units, **tables)
@@ -0,0 +1,120 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+
+MANIFEST_SUFFIX = '.manifest.json'
+# Read once at import: os.umask can only be read by setting it, which would race with other threads
+UMASK = os.umask(0)
+os.umask(UMASK)
+# Bump when what goes into a fingerprint changes; changes to the layout code
+# itself are caught by the layout_version callers pass in
+FINGERPRINT_VERSION = 1
+
+
+def template_digest(template_bytes):
+    return hashlib.sha256(template_bytes).hexdigest()
+
+
+def stop_fingerprint(grouped_timetables, context, stop_headsign_index_dict, template_hash, headsign_colors, layout_version):
+    # Only what ends up in the document is hashed: group names, arrival times
+    # and headsign indices in row order, the context fields, the legend, the
+    # template and the layout code. The dates behind each group are left out,
+    # so a stop whose timetable is the same as last week's still matches
+    h = hashlib.sha256()
+    header = {
+        'version': FINGERPRINT_VERSION,
+        'layout': layout_version,
+        'template': template_hash,
+        'context': {key: str(value) for key, value in sorted(context.items())},
+        'headsigns': sorted((int(index), str(headsign)) for index, headsign in stop_headsign_index_dict.items()),
+        'colors': sorted((int(index), color) for index, color in headsign_colors.items()),
+        'groups': list(grouped_timetables),
+    }
+    h.update(json.dumps(header, ensure_ascii=False).encode('utf-8'))
+    for dates, group_timetable in grouped_timetables.values():
+        h.update(np.ascontiguousarray(group_timetable['arrival_seconds'].to_numpy(dtype=np.int64)).tobytes())
+        h.update(np.ascontiguousarray(group_timetable['headsign_index'].to_numpy(dtype=np.int64)).tobytes())
+    return h.hexdigest()
+
+
+def publish_file(tmp_path, path):
+    # mkstemp files are owner-only; published ones get the mode a plain open() would give
+    os.chmod(tmp_path, 0o666 & ~UMASK)
+    os.replace(tmp_path, path)
+
+
+def manifest_path(archive_path):
+    return archive_path + MANIFEST_SUFFIX
+
+
+class DocumentManifest:
+    """Fingerprint of every stop document written to one archive.
+
+    Saved as <archive>.manifest.json next to the archive. A manifest loaded
+    from a previous run hands back the stored .docx bytes of any document
+    whose fingerprint has not changed, so only changed stops are re-rendered.
+    """
+
+    def __init__(self, documents=None, archive_path=None):
+        self.documents = documents or {}
+        self.archive_path = archive_path
+        self.reused = []
+        self.rendered = []
+        self._zip = None
+
+    @classmethod
+    def load(cls, archive_path):
+        path = manifest_path(archive_path)
+        if not os.path.exists(path) or not os.path.exists(archive_path):
+            return cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                documents = json.load(f)['documents']
+        except (OSError, ValueError, KeyError):
+            return cls()
+        return cls(documents, archive_path)
+
+    def add(self, doc_filename, stop_id, fingerprint, reused):
+        self.documents[doc_filename] = {'stop_id': stop_id, 'fingerprint': fingerprint}
+        (self.reused if reused else self.rendered).append(doc_filename)
+
+    def reuse(self, doc_filename, fingerprint):
+        entry = self.documents.get(doc_filename)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        try:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.archive_path)
+            return io.BytesIO(self._zip.read(doc_filename))
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return None
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def save(self, archive_path):
+        path = manifest_path(archive_path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.manifest.', dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'documents': self.documents}, f, ensure_ascii=False, indent=1)
+        publish_file(tmp_path, path)
+
+    def changes(self, previous):
+        """Stop ids by change kind: new, changed, unchanged and removed."""
+        changes = {'new': [], 'changed': [], 'unchanged': [], 'removed': []}
+        for doc_filename, entry in self.documents.items():
+            previous_entry = previous.documents.get(doc_filename)
+            if previous_entry is None:
+                changes['new'].append(entry['stop_id'])
+            elif previous_entry['fingerprint'] != entry['fingerprint']:
+                changes['changed'].append(entry['stop_id'])
+            else:
+                changes['unchanged'].append(entry['stop_id'])
+        changes['removed'] = [entry['stop_id'] for doc_filename, entry in previous.documents.items() if doc_filename not in self.documents]
+        return changes
@@ -0,0 +1,162 @@
+import sys
+import numpy as np
+import pandas as pd
+from utils import time_to_seconds
+from profiling import profile_stage
+
+TIMETABLE_COLUMNS = ["route_id", "trip_id", "trip_headsign", "arrival_seconds", "stop_id", "stop_sequence", "pattern"]
+
+def get_first_and_subsequent_weeks(service_calendar):
+    return service_calendar.valid_mondays()
+
+def get_week_dates(monday):
+    return [(monday + pd.DateOffset(days=i)).strftime('%Y%m%d') for i in range(7)]
+
+def get_route_timetable(feed, service_calendar, route_id, week_dates, columns=None):
+    return get_routes_timetable(feed, service_calendar, [(route_id, None)], week_dates, columns)
+
+def get_routes_timetable(feed, service_calendar, routes, week_dates, columns=None):
+    """Timetable of several routes extracted together, for combined lines.
+
+    routes are (route_id, alias) pairs. Headsigns of routes with an alias
+    become "alias - headsign"; an alias of None leaves them as they are.
+    """
+    route_aliases = pd.DataFrame(routes, columns=['route_id', 'alias']).astype({'route_id': feed.trips['route_id'].dtype})
+    route_trips = feed.trips.merge(route_aliases, on='route_id')
+    # Prefixing happens on the few trip rows, before they fan out to stop_times
+    aliased = route_trips['alias'].notna()
+    if aliased.any():
+        route_trips['trip_headsign'] = route_trips['trip_headsign'].mask(aliased, route_trips['alias'].astype('string') + " - " + route_trips['trip_headsign'])
+    route_trips = route_trips.drop(columns='alias')
+
+    # One copy of each trip's stop_times per distinct service pattern of the
+    # week rather than per date; dates map back via service_calendar.group_dates
+    pattern_trips = [
+        route_trips[route_trips['service_id'].isin(service_calendar.patterns[pattern])].assign(pattern=pattern)
+        for pattern in service_calendar.group_dates(week_dates)
+    ]
+    pattern_trips = [trips for trips in pattern_trips if not trips.empty]
+    if not pattern_trips:
+        return pd.DataFrame(columns=columns or ['pattern'] + route_trips.columns.tolist() + feed.stop_times.columns.tolist() + ['arrival_seconds'])
+
+    timetable = pd.concat(pattern_trips, ignore_index=True).merge(feed.stop_times, on='trip_id')
+    timetable = timetable[timetable['arrival_time'].notna()]
+    timetable = timetable.assign(arrival_seconds=time_to_seconds(timetable['arrival_time']))
+    timetable = timetable.sort_values(['pattern', 'trip_id', 'stop_sequence'], ignore_index=True)
+    if columns:
+        timetable = timetable[columns]
+    return compact_timetable(timetable)
+
+COMPACT_DTYPES = {
+    'route_id': 'category',
+    'trip_id': 'category',
+    'stop_id': 'category',
+    'trip_headsign': 'category',
+    'arrival_seconds': 'int32',
+    'stop_sequence': 'int32',
+    'pattern': 'int16',
+}
+
+def compact_timetable(timetable):
+    return timetable.astype({column: dtype for column, dtype in COMPACT_DTYPES.items() if column in timetable.columns})
+
+def pattern_date_counts(timetable, pattern_dates):
+    # Each pattern row stands for one departure on every date of its pattern
+    return timetable['pattern'].map({pattern: len(dates) for pattern, dates in pattern_dates.items()})
+
+# Python string sizes of the values the original timetable held in place of
+# arrival_seconds ('HH:MM:SS') and pattern (one 'YYYYMMDD' row per date)
+BOXED_VALUE_SIZES = {'arrival_seconds': sys.getsizeof('00:00:00'), 'pattern': sys.getsizeof('20240101')}
+POINTER_BYTES = 8
+
+def timetable_memory_report(timetable, pattern_dates):
+    """Memory of the compact timetable next to the frame it replaces.
+
+    The baseline is the timetable as gtfs_kit's build_route_timetable used to
+    return it: one row per trip stop and date, with ids, headsigns, stop types,
+    arrival times and dates as Python strings and numbers as int64. It is
+    estimated column by column from the distinct values, as
+    memory_usage(deep=True) would count it, without building that frame.
+    """
+    rows = pattern_date_counts(timetable, pattern_dates).to_numpy(dtype=np.int64)
+    baseline = {}
+    for column in timetable.columns:
+        values = timetable[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Code -1 (missing) picks the trailing NaN size
+            sizes = [sys.getsizeof(value) for value in values.cat.categories] + [sys.getsizeof(np.nan)]
+            codes = values.cat.codes.to_numpy()
+        elif column == 'stop_type':
+            sizes = [sys.getsizeof(stop_type) for stop_type in STOP_TYPES]
+            codes = values.to_numpy()
+        elif column in BOXED_VALUE_SIZES:
+            sizes = [BOXED_VALUE_SIZES[column]]
+            codes = np.zeros(len(values), dtype=np.int8)
+        else:
+            baseline[column] = np.dtype(np.int64).itemsize * rows.sum()
+            continue
+        baseline[column] = ((np.asarray(sizes, dtype=np.int64)[codes] + POINTER_BYTES) * rows).sum()
+
+    baseline = pd.Series(baseline, dtype=np.int64)
+    compact = timetable.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({'dtype': timetable.dtypes.astype(str), 'baseline_bytes': baseline, 'compact_bytes': compact})
+    report.loc['total'] = ['', baseline.sum(), compact.sum()]
+    report['reduction'] = 1 - report['compact_bytes'] / report['baseline_bytes']
+    return report
+
+def check_stop_sequences(trips, stop_times):
+    trip_stop_sequences = stop_times.groupby('trip_id')['stop_id'].apply(tuple).reset_index()
+    trips = trips.merge(trip_stop_sequences, on='trip_id')
+    headsign_stop_sequences = trips.groupby('trip_headsign')['stop_id'].unique().reset_index()
+    headsign_stop_sequences['stop_sequence_str'] = headsign_stop_sequences['stop_id'].apply(lambda x: ' -> '.join(map(str, x)))
+    return headsign_stop_sequences
+
+STOP_TYPES = ['Stop', 'Start', 'Finish']
+STOP, START, FINISH = range(len(STOP_TYPES))
+
+def classify_stops(timetable):
+    timetable = timetable.sort_values(['trip_id', 'pattern', 'stop_sequence'], ignore_index=True)
+    stop_sequences = timetable.groupby(['trip_id', 'pattern'], observed=True)['stop_sequence']
+    stop_type = np.full(len(timetable), STOP, dtype=np.uint8)
+    stop_type[(timetable['stop_sequence'] == stop_sequences.transform('min')).to_numpy()] = START
+    stop_type[(timetable['stop_sequence'] == stop_sequences.transform('max')).to_numpy()] = FINISH
+    timetable['stop_type'] = stop_type
+    return timetable
+
+def index_headsigns(timetable, pattern_dates):
+    headsign_index_dict = {}
+    date_counts = pattern_date_counts(timetable, pattern_dates)
+    headsign_counts = date_counts.groupby([timetable['stop_id'], timetable['trip_headsign']], observed=True).sum().reset_index(name='count')
+    headsign_counts['headsign_index'] = headsign_counts.groupby('stop_id', observed=True)['count'].rank("dense", ascending=False).astype(int)
+    headsign_index_dict = headsign_counts.groupby('stop_id', observed=True).apply(
+        lambda x: dict(zip(x['headsign_index'], x['trip_headsign']))
+    ).to_dict()
+    headsign_index_map = headsign_counts.set_index(['stop_id', 'trip_headsign'])['headsign_index']
+    headsign_index = timetable.set_index(['stop_id', 'trip_headsign']).index.map(headsign_index_map)
+    timetable['headsign_index'] = pd.to_numeric(np.asarray(headsign_index), downcast='unsigned')
+    return headsign_index_dict
+
+def build_route_timetable(feed, service_calendar, route_id, week_dates, additional_routes=(), profile=None):
+    """Timetable of route_id for week_dates, ready for generate_word_documents.
+
+    additional_routes are (alias, route_id) pairs whose trips are merged in
+    with their headsigns prefixed by the alias. Returns the timetable, the
+    dates of each service pattern and the per-stop headsign dict, or None
+    when the main route has no service that week.
+    """
+    pattern_dates = service_calendar.group_dates(week_dates)
+    routes = [(route_id, None)] + [(additional_route_id, alias) for alias, additional_route_id in additional_routes]
+    with profile_stage(profile, 'get_route_timetable') as stage:
+        timetable = get_routes_timetable(feed, service_calendar, routes, week_dates, TIMETABLE_COLUMNS)
+        stage['rows'] = len(timetable)
+    if timetable.empty or not (timetable['route_id'] == route_id).any():
+        return None
+
+    with profile_stage(profile, 'classify_stops') as stage:
+        timetable = classify_stops(timetable)
+        timetable = timetable[timetable['stop_type'] != FINISH].reset_index(drop=True)
+        stage['rows'] = len(timetable)
+
+    with profile_stage(profile, 'index_headsigns', rows=len(timetable)):
+        headsign_index_dict = index_headsigns(timetable, pattern_dates)
+    return timetable, pattern_dates, headsign_index_dict
@@ -0,0 +1,131 @@
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+# tracemalloc is process wide: traced stages of concurrent runs take turns
+TRACE_LOCK = threading.RLock()
+
+
+def peak_rss(who='self'):
+    # High-water mark over the whole life of the process (or of its largest child)
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss * RSS_UNIT
+
+
+def current_rss():
+    # Only Linux exposes the current resident set size without psutil
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        return None
+
+
+class RunProfile:
+    """Per-stage wall time, memory and row counts of one generation run.
+
+    Pipeline functions take an optional profile and wrap their stages in
+    profile.stage(). Each stage records how much the resident set grew or
+    shrank over it (Linux only) and the process-wide RSS high-water mark
+    when it ends; worker processes report theirs once they have exited. Both
+    include whatever else the process was doing at the time. With
+    trace_memory, each stage also records its tracemalloc peak, at the cost
+    of slower allocations; traced stages of concurrent runs wait for each
+    other, but allocations of untraced runs in other threads still count.
+    With profile_slowest_stop, the slowest stop is rendered once more under
+    cProfile after the run.
+    """
+
+    def __init__(self, trace_memory=False, profile_slowest_stop=False):
+        self.trace_memory = trace_memory
+        self.profile_slowest_stop = profile_slowest_stop
+        self.stages = []
+        self.stop_seconds = {}
+        self.slowest_stop_profile = None
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        record = {'stage': name, 'seconds': None, 'rows': rows}
+        with TRACE_LOCK if self.trace_memory else contextlib.nullcontext():
+            tracing = self.trace_memory and not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            rss_before = current_rss()
+            start = time.perf_counter()
+            try:
+                yield record
+            finally:
+                record['seconds'] = time.perf_counter() - start
+                if tracing:
+                    record['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                rss_after = current_rss()
+                record['rss_delta_bytes'] = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+                record['process_peak_rss_bytes'] = peak_rss('self')
+                record['worker_peak_rss_bytes'] = peak_rss('children')
+                self.stages.append(record)
+
+    def record_stop(self, doc_filename, seconds):
+        self.stop_seconds[doc_filename] = seconds
+
+    def capture_slowest_stop(self, render, doc_filename):
+        profiler = cProfile.Profile()
+        profiler.runcall(render)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(30)
+        self.slowest_stop_profile = {'document': doc_filename, 'stats': output.getvalue()}
+
+    def slowest_stop(self):
+        if not self.stop_seconds:
+            return None
+        return max(self.stop_seconds, key=self.stop_seconds.get)
+
+    def stop_summary(self):
+        seconds = sorted(self.stop_seconds.values())
+        if not seconds:
+            return {'stops': 0}
+        return {
+            'stops': len(seconds),
+            'total_seconds': sum(seconds),
+            'min_seconds': seconds[0],
+            'median_seconds': statistics.median(seconds),
+            'p90_seconds': seconds[min(len(seconds) - 1, int(len(seconds) * 0.9))],
+            'max_seconds': seconds[-1],
+            'slowest_stop': self.slowest_stop(),
+        }
+
+    def to_dict(self):
+        return {
+            'stages': self.stages,
+            'stop_render': self.stop_summary(),
+            'stop_seconds': self.stop_seconds,
+            'slowest_stop_profile': self.slowest_stop_profile,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+def profile_stage(profile, name, rows=None):
+    # Pipeline functions run the same way with or without a profile
+    if profile is None:
+        return contextlib.nullcontext({})
+    return profile.stage(name, rows)
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+class ServiceCalendar:
+    """Date -> active service_ids/trips index of a feed, built once.
+
+    The date span follows gtfs_kit's ``get_dates``: every day between the
+    earliest and latest date found in calendar and calendar_dates. Dates whose
+    active service sets are identical share the same pattern id.
+    """
+
+    def __init__(self, feed):
+        self.dates = self._feed_dates(feed)
+        self.services_by_date = self._active_services(feed, self.dates)
+
+        self.patterns = []
+        self.pattern_by_date = {}
+        self.dates_by_pattern = []
+        pattern_ids = {}
+        for date in self.dates:
+            services = self.services_by_date[date]
+            if services not in pattern_ids:
+                pattern_ids[services] = len(self.patterns)
+                self.patterns.append(services)
+                self.dates_by_pattern.append([])
+            self.pattern_by_date[date] = pattern_ids[services]
+            self.dates_by_pattern[pattern_ids[services]].append(date)
+
+        trips = feed.trips[['service_id', 'trip_id']] if feed.trips is not None else pd.DataFrame(columns=['service_id', 'trip_id'])
+        self.trips_by_service = {service_id: group.to_numpy() for service_id, group in trips.groupby('service_id')['trip_id']}
+
+    @staticmethod
+    def _feed_dates(feed):
+        bounds = []
+        if feed.calendar is not None and not feed.calendar.empty:
+            bounds += [feed.calendar['start_date'].min(), feed.calendar['end_date'].max()]
+        if feed.calendar_dates is not None and not feed.calendar_dates.empty:
+            bounds += [feed.calendar_dates['date'].min(), feed.calendar_dates['date'].max()]
+        if not bounds:
+            return []
+        span = pd.date_range(pd.to_datetime(min(bounds), format='%Y%m%d'), pd.to_datetime(max(bounds), format='%Y%m%d'))
+        return span.strftime('%Y%m%d').tolist()
+
+    @staticmethod
+    def _active_services(feed, dates):
+        active = {date: set() for date in dates}
+        if not dates:
+            return {}
+
+        if feed.calendar is not None and not feed.calendar.empty:
+            calendar = feed.calendar
+            date_values = np.array(dates)
+            weekdays = pd.to_datetime(date_values, format='%Y%m%d').weekday.to_numpy()
+            runs_on_weekday = calendar[WEEKDAYS].fillna(0).astype(int).to_numpy()[:, weekdays] == 1
+            in_range = (calendar['start_date'].to_numpy()[:, None] <= date_values) & (date_values <= calendar['end_date'].to_numpy()[:, None])
+            service_idx, date_idx = np.nonzero(runs_on_weekday & in_range)
+            service_ids = calendar['service_id'].to_numpy()
+            for s, d in zip(service_idx, date_idx):
+                active[dates[d]].add(service_ids[s])
+
+        if feed.calendar_dates is not None and not feed.calendar_dates.empty:
+            exceptions = feed.calendar_dates[feed.calendar_dates['date'].isin(active.keys())]
+            for date, service_id in exceptions.loc[exceptions['exception_type'] == 1, ['date', 'service_id']].itertuples(index=False):
+                active[date].add(service_id)
+            for date, service_id in exceptions.loc[exceptions['exception_type'] == 2, ['date', 'service_id']].itertuples(index=False):
+                active[date].discard(service_id)
+
+        return {date: frozenset(services) for date, services in active.items()}
+
+    def valid_mondays(self, as_date_obj=True):
+        dates = pd.to_datetime(pd.Series(self.dates, dtype=object), format='%Y%m%d')
+        mondays = dates[dates.dt.weekday == 0]
+        if as_date_obj:
+            return mondays.dt.date.tolist()
+        return mondays.dt.strftime('%Y%m%d').tolist()
+
+    def services_on(self, date):
+        return self.services_by_date.get(date, frozenset())
+
+    def trips_on(self, date):
+        trips = [self.trips_by_service[s] for s in self.services_on(date) if s in self.trips_by_service]
+        return np.concatenate(trips) if trips else np.array([], dtype=object)
+
+    def pattern_on(self, date):
+        return self.pattern_by_date.get(date)
+
+    def dates_sharing_services(self, date):
+        pattern = self.pattern_on(date)
+        return list(self.dates_by_pattern[pattern]) if pattern is not None else []
+
+    def group_dates(self, dates):
+        groups = {}
+        for date in dates:
+            pattern = self.pattern_on(date)
+            if pattern is not None:
+                groups.setdefault(pattern, []).append(date)
+        return groups
@@ -1,6 +1,18 @@
 import datetime
+import functools
+import hashlib
+import inspect
+from collections import namedtuple
+import numpy as np
 import pandas as pd
 
+def source_digest(*modules):
+    # Changes whenever the code of any of the modules does
+    h = hashlib.blake2b(digest_size=8)
+    for module in modules:
+        h.update(inspect.getsource(module).encode('utf-8'))
+    return h.hexdigest()
+
 # Mapping from day index to French day names
 french_days = ['lundi', 'mardi', 'mercredi', 'jeudi', 'vendredi', 'samedi', 'dimanche']
 
@@ -65,73 +77,110 @@ def generate_group_name(dates):
     
     return ', '.join(result)
 
-def group_dates_by_timetables(df, stop_id):
-    filtered_stop_data = df[df['stop_id'] == stop_id]
-    grouped = filtered_stop_data.groupby('date')
-    timetables = {}
-
-    for date, group in grouped:
-        timetable = tuple(map(tuple, group[['arrival_time']].values))
-        timetable_hash = hash(timetable)
-        
-        if timetable_hash in timetables:
-            timetables[timetable_hash][0].append(date)
+@functools.lru_cache(maxsize=1024)
+def cached_group_name(dates):
+    return generate_group_name(dates)
+
+def group_all_dates_by_timetables(df, pattern_dates):
+    if df.empty:
+        return {}
+
+    # Hash every (stop, pattern) arrival sequence in one pass: each row hash
+    # mixes in the row's position within its sequence, and the per-sequence
+    # sum (wrapping uint64) together with the length identifies the sequence
+    keys = [df['stop_id'], df['pattern']]
+    position = df.groupby(keys, sort=False, observed=True).cumcount()
+    row_hashes = pd.util.hash_pandas_object(
+        pd.DataFrame({'arrival_seconds': df['arrival_seconds'].to_numpy(), 'position': position.to_numpy()}), index=False
+    )
+    row_hashes.index = df.index
+    sequences = row_hashes.groupby(keys, sort=False, observed=True).agg(['sum', 'size'])
+    rows_by_sequence = df.groupby(keys, sort=False, observed=True).indices
+
+    grouped = {}
+    for (stop_id, pattern), (sequence_hash, size) in zip(sequences.index, sequences.itertuples(index=False)):
+        timetables = grouped.setdefault(stop_id, {})
+        if (sequence_hash, size) in timetables:
+            timetables[(sequence_hash, size)][0].extend(pattern_dates[pattern])
         else:
-            timetables[timetable_hash] = ([date], group)
-    
-    named_groups = {generate_group_name(dates): (dates, timetable) for dates, timetable in timetables.values()}
-    return named_groups
-
-
-def organize_times_by_hour(times, headsign_indices=None):
-    if times.isna().all():
+            timetables[(sequence_hash, size)] = (list(pattern_dates[pattern]), df.iloc[rows_by_sequence[(stop_id, pattern)]])
+
+    named_groups_by_stop = {}
+    for stop_id, timetables in grouped.items():
+        named_groups = {}
+        for dates, timetable in sorted(timetables.values(), key=lambda x: min(x[0])):
+            dates.sort()
+            named_groups[cached_group_name(tuple(dates))] = (dates, timetable)
+        named_groups_by_stop[stop_id] = named_groups
+    return named_groups_by_stop
+
+def group_dates_by_timetables(df, stop_id, pattern_dates):
+    return group_all_dates_by_timetables(df[df['stop_id'] == stop_id], pattern_dates).get(stop_id, {})
+
+StopPartition = namedtuple('StopPartition', ['rows', 'stop_name', 'direction', 'headsigns', 'grouped_timetables'])
+
+def partition_timetable_by_stop(timetable, pattern_dates, stops, headsign_index_dict):
+    # One groupby for the row slices and one lookup table for the names, so
+    # nothing downstream has to mask the whole timetable per stop
+    rows_by_stop = timetable.groupby('stop_id', sort=False, observed=True).indices
+    stop_names = stops.loc[stops['stop_id'].isin(list(rows_by_stop)), ['stop_id', 'stop_name']].drop_duplicates('stop_id')
+    stop_names = dict(zip(stop_names['stop_id'], stop_names['stop_name']))
+    grouped_timetables = group_all_dates_by_timetables(timetable, pattern_dates)
+
+    partitions = {}
+    for stop_id, positions in rows_by_stop.items():
+        rows = timetable.iloc[positions]
+        # Headsign of the stop's first row with the lowest (most frequent) index
+        direction = rows['trip_headsign'].iloc[rows['headsign_index'].to_numpy().argmin()]
+        partitions[stop_id] = StopPartition(
+            rows=rows,
+            stop_name=stop_names.get(stop_id),
+            direction=direction,
+            headsigns=headsign_index_dict[stop_id],
+            grouped_timetables=grouped_timetables[stop_id],
+        )
+    return partitions
+
+
+MINUTE_LABELS = np.array([f"{minute:02}" for minute in range(60)], dtype=object)
+
+def time_to_seconds(times):
+    if times.empty:
+        return pd.Series(dtype='int64', index=times.index)
+    parts = times.str.split(':', n=2, expand=True).astype('int64')
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+def organize_times_by_hour(seconds, headsign_indices=None):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    if seconds.size == 0:
         return pd.DataFrame(), pd.DataFrame()
 
-    # Split times into hours and minutes
-    split_times = times.apply(lambda x: x.split(':'))
-    truncated_hours = split_times.apply(lambda x: x[0])
-    truncated_minutes = split_times.apply(lambda x: x[1])
+    hours = seconds // 3600
+    minutes = seconds % 3600 // 60
+    # Sort departures by hour then minute, carrying the headsign indices along
+    order = np.lexsort((minutes, hours))
+    hours, minutes = hours[order], minutes[order]
 
-    if truncated_hours.empty:
-        return pd.DataFrame(), pd.DataFrame()
-
-    unique_hours = sorted(truncated_hours.unique(), key=lambda x: int(x))
-    timetable = pd.DataFrame(index=range(truncated_hours.value_counts().max()), columns=unique_hours)
-    headsign_index_table = pd.DataFrame(index=range(truncated_hours.value_counts().max()), columns=unique_hours)
-
-    for hour in unique_hours:
-        # Get the minutes corresponding to the current hour
-        minutes_in_hour = truncated_minutes[truncated_hours == hour].tolist()
-        minutes_in_hour.sort(key=lambda x: int(x))  # Ensure minutes are sorted within each hour
+    unique_hours, column_index, counts = np.unique(hours, return_inverse=True, return_counts=True)
+    row_index = np.arange(hours.size) - np.repeat(np.cumsum(counts) - counts, counts)
 
-        if headsign_indices is not None:
-            headsign_indices_in_hour = headsign_indices[truncated_hours == hour].tolist()
+    grid = np.full((counts.max(), unique_hours.size), '', dtype=object)
+    grid[row_index, column_index] = MINUTE_LABELS[minutes]
+    headsign_grid = np.full(grid.shape, '', dtype=object)
+    if headsign_indices is not None:
+        headsign_grid[row_index, column_index] = np.asarray(headsign_indices, dtype=object)[order]
 
-        for i, minute in enumerate(minutes_in_hour):
-            timetable.at[i, hour] = minute
-            if headsign_indices is not None:
-                headsign_index_table.at[i, hour] = headsign_indices_in_hour[i]
-
-    # Rename columns to have 'h' suffix and ensure unique column names
-    new_columns = {}
+    # Hours past midnight wrap to 00h, 01h...; repeated labels get trailing
+    # spaces so column names stay unique
+    columns = []
     hour_counts = {}
-    for col in timetable.columns:
-        hour_int = int(col)
-        hour_str = f"{hour_int % 24:02}h"
+    for hour in unique_hours:
+        hour_str = f"{hour % 24:02}h"
         if hour_str in hour_counts:
             hour_counts[hour_str] += 1
-            hour_str += ' ' * hour_counts[hour_str]  # Append spaces to make it unique
+            hour_str += ' ' * hour_counts[hour_str]
         else:
             hour_counts[hour_str] = 0
-        new_columns[col] = hour_str
-
-    timetable.rename(columns=new_columns, inplace=True)
-    timetable.fillna('', inplace=True)
-    
-    headsign_index_table.rename(columns=new_columns, inplace=True)
-    headsign_index_table.fillna('', inplace=True)
-
-    return timetable, headsign_index_table
-
-
+        columns.append(hour_str)
 
+    return pd.DataFrame(grid, columns=columns), pd.DataFrame(headsign_grid, columns=columns)